@@ -8,6 +8,20 @@ class Settings(BaseModel):
     unbound_api_key: str = os.getenv("UNBOUND_API_KEY", "")
     unbound_chat_url: str = os.getenv("UNBOUND_CHAT_URL", "")
     unbound_timeout_seconds: int = int(os.getenv("UNBOUND_TIMEOUT_SECONDS", "60"))
+    # Stream completions and stop early once the step criteria is decided (truncates output)
+    unbound_stream: bool = os.getenv("UNBOUND_STREAM", "0") == "1"
+    llm_concurrency: int = int(os.getenv("LLM_CONCURRENCY", "8"))
+    # Evaluate regex criteria with RE2 (google-re2, linear time). Opt-in: RE2's \w/\d/\s are
+    # ASCII-only and `$` doesn't match before a trailing newline, so results can differ from `re`
+    regex_re2: bool = os.getenv("REGEX_RE2", "0") == "1"
+    # Shared HTTP client pool; HTTP/2 (one multiplexed connection) needs the optional h2 package
+    http_max_connections: int = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+    http_max_keepalive: int = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+    unbound_http2: bool = os.getenv("UNBOUND_HTTP2", "0") == "1"
+    # Create tables/indexes on startup; set to 0 and run app.db.init_db() once per deploy
+    auto_migrate: bool = os.getenv("AUTO_MIGRATE", "1") == "1"
+    # Demo runner logs keep only prompt length; set to 1 to include the full prompt sent
+    demo_log_prompts: bool = os.getenv("DEMO_LOG_PROMPTS", "0") == "1"
 
 settings = Settings()
 
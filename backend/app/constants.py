@@ -0,0 +1,24 @@
+from __future__ import annotations
+
+from enum import StrEnum
+
+
+class ModelName(StrEnum):
+    K2P5 = "kimi-k2p5"
+    K2_INSTRUCT = "kimi-k2-instruct-0905"
+
+
+class ContextMode(StrEnum):
+    FULL = "full"
+    CODE_ONLY = "code_only"
+    NONE = "none"  # output not passed forward (next step starts fresh)
+
+
+class CriteriaType(StrEnum):
+    CONTAINS = "contains"
+    REGEX = "regex"
+    JSON_VALID = "json_valid"
+
+
+# StrEnum members hash like their values, so plain strings can be checked directly
+ALLOWED_MODELS = frozenset(ModelName)
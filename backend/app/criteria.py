@@ -3,7 +3,23 @@ from __future__ import annotations
 import json
 import re
 from dataclasses import dataclass
-from typing import Any, Dict, Optional, Tuple
+from functools import lru_cache
+from typing import Any, Callable, Dict, Optional, Tuple
+
+try:
+    import orjson  # optional: much faster C/SIMD parser for json_valid
+except ImportError:
+    orjson = None
+
+from app.config import settings
+
+try:
+    import re2  # optional (google-re2): linear-time regex engine, used only with REGEX_RE2=1
+except ImportError:
+    re2 = None
+
+if settings.regex_re2 and re2 is None:
+    print("⚠️  REGEX_RE2=1 but google-re2 is not installed; using Python's re")
 
 
 @dataclass
@@ -12,6 +28,167 @@ class CriteriaResult:
     reason: str
 
 
+# Verdicts for a partial (still streaming) output, see make_partial_validator()
+PARTIAL_CONTINUE = "continue"
+PARTIAL_VALID = "valid"
+PARTIAL_INVALID = "invalid"
+
+# First non-whitespace char of any JSON document
+_JSON_START_CHARS = frozenset('{["tfn-0123456789')
+
+
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _json_error(text: str) -> Optional[str]:
+    """
+    Returns None if text is one valid JSON document, else a short failure reason.
+    """
+    if orjson is not None:
+        try:
+            orjson.loads(text)
+        except orjson.JSONDecodeError as e:
+            return f"parse failed ({type(e).__name__})"
+        return None
+
+    try:
+        # raw_decode stops at the end of the first value; anything after it is garbage
+        _, end = _JSON_DECODER.raw_decode(text)
+    except Exception as e:
+        return f"parse failed ({type(e).__name__})"
+    if end != len(text):
+        return f"trailing data at {end}"
+    return None
+
+
+def _re2_compile(pattern: str, flags: int):
+    # RE2 takes the same i/m/s modifiers inline; raises re2.error on unsupported syntax
+    inline = "".join(c for c, f in (("i", re.IGNORECASE), ("m", re.MULTILINE), ("s", re.DOTALL)) if flags & f)
+    options = re2.Options()
+    options.log_errors = False
+    return re2.compile(f"(?{inline}){pattern}" if inline else pattern, options)
+
+
+@lru_cache(maxsize=512)
+def _compiled(pattern: str, flags: int):
+    """
+    Compiled pattern with a .search(text) method; cached since the same step
+    patterns recur on every attempt/run.
+
+    Both pattern and text are user/LLM controlled, so REGEX_RE2=1 switches to RE2
+    (linear time, no catastrophic backtracking). It is opt-in because RE2 classes
+    (\\w, \\d, \\s) are ASCII-only and `$` without "m" only matches at the very
+    end, so saved workflows could change verdicts. Patterns RE2 can't express
+    (backreferences, lookarounds) fall back to `re`.
+    """
+    if settings.regex_re2 and re2 is not None:
+        try:
+            return _re2_compile(pattern, flags)
+        except re2.error:
+            pass
+    return re.compile(pattern, flags)
+
+
+def _parse_flags(flags: str) -> int:
+    re_flags = 0
+    if "i" in flags:
+        re_flags |= re.IGNORECASE
+    if "m" in flags:
+        re_flags |= re.MULTILINE
+    if "s" in flags:
+        re_flags |= re.DOTALL
+    return re_flags
+
+
+# Flags used for regex criteria of stored workflow steps (LLM outputs span lines)
+STEP_REGEX_FLAGS = "s"
+
+
+def compile_regex(pattern: str, flags: str = ""):
+    """
+    Compile a regex criterion through the shared cache (raises re.error if invalid).
+    """
+    return _compiled(pattern, _parse_flags(flags))
+
+
+Validator = Callable[[str], CriteriaResult]
+
+
+def _contains_validator(criteria: Dict[str, Any]) -> Validator:
+    keyword = criteria.get("keyword", "")
+    if not keyword:
+        missing = CriteriaResult(False, "contains: missing keyword")
+        return lambda output_text: missing
+
+    def check_contains(output_text: str) -> CriteriaResult:
+        # Deliberately str-level: CPython searches at the haystack's native width
+        # and returns early when the keyword is wider; encoding to UTF-8 bytes first
+        # would add a full copy of the output per attempt.
+        # find() gives the match offset for the log in the same scan
+        idx = (output_text or "").find(keyword)
+        if idx < 0:
+            return CriteriaResult(False, f"contains: missing '{keyword}'")
+        return CriteriaResult(True, f"contains: found '{keyword}' at {idx}")
+
+    return check_contains
+
+
+def _regex_validator(criteria: Dict[str, Any]) -> Validator:
+    pattern = criteria.get("pattern", "")
+    if not pattern:
+        missing = CriteriaResult(False, "regex: missing pattern")
+        return lambda output_text: missing
+
+    # Runs on the event loop: `re` holds the GIL for the whole search, so a worker thread
+    # wouldn't unblock other runs. Use REGEX_RE2=1 against catastrophic (ReDoS) patterns
+    search = _compiled(pattern, _parse_flags(criteria.get("flags", ""))).search
+
+    def check_regex(output_text: str) -> CriteriaResult:
+        ok = search(output_text or "") is not None
+        return CriteriaResult(ok, f"regex: {'matched' if ok else 'no match'}")
+
+    return check_regex
+
+
+def _json_validator(criteria: Dict[str, Any]) -> Validator:
+    def check_json(output_text: str) -> CriteriaResult:
+        text = (output_text or "").strip(" \t\n\r")  # JSON whitespace only
+        # cheap reject before the parser (prose, code fences, empty output)
+        if not text or text[0] not in _JSON_START_CHARS:
+            return CriteriaResult(False, "json_valid: not JSON-shaped")
+        err = _json_error(text)
+        if err:
+            return CriteriaResult(False, f"json_valid: {err}")
+        return CriteriaResult(True, "json_valid: parsed")
+
+    return check_json
+
+
+# criteria type -> factory building that type's validator
+_VALIDATOR_FACTORIES: Dict[str, Callable[[Dict[str, Any]], Validator]] = {
+    "contains": _contains_validator,
+    "regex": _regex_validator,
+    "json_valid": _json_validator,
+}
+
+
+def make_validator(criteria: Dict[str, Any]) -> Validator:
+    """
+    Resolve criteria once (type dispatch, keyword, compiled regex) and return
+    a callable applied to each attempt's output. Same criteria format as evaluate().
+    """
+    if not criteria or "type" not in criteria:
+        no_criteria = CriteriaResult(True, "no_criteria")
+        return lambda output_text: no_criteria
+
+    ctype = criteria.get("type")
+    factory = _VALIDATOR_FACTORIES.get(ctype) if isinstance(ctype, str) else None
+    if factory is None:
+        unknown = CriteriaResult(False, f"unknown criteria type: {ctype}")
+        return lambda output_text: unknown
+    return factory(criteria)
+
+
 def evaluate(output_text: str, criteria: Dict[str, Any]) -> CriteriaResult:
     """
     criteria format examples:
@@ -21,40 +198,43 @@ def evaluate(output_text: str, criteria: Dict[str, Any]) -> CriteriaResult:
 
     Returns: CriteriaResult(passed, reason)
     """
+    return make_validator(criteria)(output_text)
+
+
+def make_partial_validator(criteria: Dict[str, Any]) -> Optional[Callable[[str], str]]:
+    """
+    Streaming counterpart of make_validator(): maps the output-so-far to
+    PARTIAL_VALID (criteria already satisfied, stop generating), PARTIAL_INVALID
+    (can no longer pass, stop and retry) or PARTIAL_CONTINUE.
+
+    Returns None when there is nothing to decide early (no/unknown criteria).
+    """
     if not criteria or "type" not in criteria:
-        return CriteriaResult(True, "no_criteria")
+        return None
 
     ctype = criteria.get("type")
 
     if ctype == "contains":
         keyword = criteria.get("keyword", "")
         if not keyword:
-            return CriteriaResult(False, "contains: missing keyword")
-        ok = keyword in (output_text or "")
-        return CriteriaResult(ok, f"contains: {'found' if ok else 'missing'} '{keyword}'")
+            return None
+        return lambda text: PARTIAL_VALID if keyword in text else PARTIAL_CONTINUE
 
     if ctype == "regex":
         pattern = criteria.get("pattern", "")
-        flags = criteria.get("flags", "")
         if not pattern:
-            return CriteriaResult(False, "regex: missing pattern")
-
-        re_flags = 0
-        if "i" in flags:
-            re_flags |= re.IGNORECASE
-        if "m" in flags:
-            re_flags |= re.MULTILINE
-        if "s" in flags:
-            re_flags |= re.DOTALL
-
-        ok = re.search(pattern, output_text or "", flags=re_flags) is not None
-        return CriteriaResult(ok, f"regex: {'matched' if ok else 'no match'}")
+            return None
+        search = _compiled(pattern, _parse_flags(criteria.get("flags", ""))).search
+        return lambda text: PARTIAL_VALID if search(text) is not None else PARTIAL_CONTINUE
 
     if ctype == "json_valid":
-        try:
-            json.loads(output_text or "")
-            return CriteriaResult(True, "json_valid: parsed")
-        except Exception as e:
-            return CriteriaResult(False, f"json_valid: parse failed ({type(e).__name__})")
+        def check_json_prefix(text: str) -> str:
+            head = text.lstrip(" \t\n\r")
+            if not head:
+                return PARTIAL_CONTINUE
+            # JSON is only decided at the end, but a non-JSON first char never recovers
+            return PARTIAL_CONTINUE if head[0] in _JSON_START_CHARS else PARTIAL_INVALID
+
+        return check_json_prefix
 
-    return CriteriaResult(False, f"unknown criteria type: {ctype}")
\ No newline at end of file
+    return None
@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 # SQLite file will be created inside backend/ as workflows.db (same as your tree)
@@ -11,6 +11,21 @@ engine = create_engine(
     connect_args={"check_same_thread": False},  # needed for SQLite + FastAPI
 )
 
+
+@event.listens_for(engine, "connect")
+def _sqlite_pragmas(dbapi_conn, _conn_record):
+    # The runner commits after every attempt so the polling UI sees live progress;
+    # WAL + synchronous=NORMAL turns each of those commits into a cheap log append
+    # and lets GET /runs/{id} read while the background run is writing
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")  # 256 MB
+    cur.execute("PRAGMA cache_size=-65536")     # 64 MB (negative = KiB)
+    cur.close()
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -21,4 +36,19 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+def init_db() -> None:
+    """
+    Create tables + indexes (idempotent). Runs on startup unless AUTO_MIGRATE=0;
+    then apply once per deploy with:
+      python -c "from app.db import init_db; init_db()"
+    """
+    from app import models  # noqa: F401  (registers tables on Base)
+
+    Base.metadata.create_all(bind=engine)
+    # create_all skips indexes of tables that already exist (older workflows.db files)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
@@ -1,11 +1,28 @@
 from __future__ import annotations
 
 import asyncio
+import json
 import random
 import httpx
-from typing import Any, Dict, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    import orjson  # optional: faster than the stdlib json behind resp.json()
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+try:
+    import h2  # noqa: F401  optional: required by httpx for UNBOUND_HTTP2=1
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
 
 from app.config import settings
+from app.criteria import PARTIAL_CONTINUE
+
+if settings.unbound_http2 and not _HTTP2_AVAILABLE:
+    print("⚠️  UNBOUND_HTTP2=1 but the h2 package is not installed (pip install h2); using HTTP/1.1")
 
 
 class UnboundError(Exception):
@@ -22,14 +39,157 @@ MODEL_TIMEOUTS_SECONDS: dict[str, float] = {
 # HTTP statuses that are usually transient (safe to retry)
 RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
 
+# Retry policy: decorrelated jitter between base and cap; server Retry-After wins (up to a ceiling)
+MAX_ATTEMPTS = 3
+BACKOFF_BASE_SECONDS = 0.6
+BACKOFF_CAP_SECONDS = 8.0
+RETRY_AFTER_MAX_SECONDS = 30.0
+
+# Streaming: run the partial check every N content chunks (it rescans the whole
+# output so far, so checking every token would be quadratic)
+STREAM_CHECK_EVERY = 4
+
+
+# Caps in-flight Unbound requests across all concurrent runs (avoids 429 storms)
+LLM_CONCURRENCY = asyncio.Semaphore(settings.llm_concurrency)
+
+
+# Shared client (opened in FastAPI lifespan) so keep-alive connections + TLS sessions
+# are reused across the many sequential calls a run makes
+_client: httpx.AsyncClient | None = None
+
+
+async def open_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(float(settings.unbound_timeout_seconds), connect=20.0),
+            limits=httpx.Limits(
+                max_connections=settings.http_max_connections,
+                max_keepalive_connections=settings.http_max_keepalive,
+            ),
+            http2=settings.unbound_http2 and _HTTP2_AVAILABLE,  # HTTP/1.1 unless opted in
+            follow_redirects=True,
+        )
+    return _client
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _retry_after_seconds(resp: httpx.Response) -> float:
+    raw = resp.headers.get("Retry-After")
+    if not raw:
+        return 0.0
+    try:
+        return min(max(float(raw), 0.0), RETRY_AFTER_MAX_SECONDS)
+    except ValueError:
+        return 0.0  # HTTP-date form: fall back to our own backoff
+
+
+def _parse_response(data: Any) -> Tuple[Optional[str], Dict[str, Any]]:
+    """
+    (text, usage) from an Unbound chat response: OpenAI-style choices[0].message.content,
+    else a flat output/text/response field.
+    """
+    if not isinstance(data, dict):
+        return None, {}
+
+    text = None
+    choices = data.get("choices")
+    if choices:
+        try:
+            text = choices[0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            pass
+    if not text:
+        text = data.get("output") or data.get("text") or data.get("response")
+
+    return text, data.get("usage") or {}
+
 
-async def call_llm(model: str, prompt: str, max_tokens: int = 400) -> Tuple[str, Dict[str, Any]]:
+async def _post_streaming(
+    client: httpx.AsyncClient,
+    url: str,
+    headers: Dict[str, str],
+    payload: Dict[str, Any],
+    timeout: httpx.Timeout,
+    on_partial: Callable[[str], str],
+) -> Tuple[httpx.Response, Optional[Tuple[str, Dict[str, Any]]]]:
+    """
+    POST with stream=True and read SSE "data:" chunks, accumulating delta content.
+    Stops reading (closing the connection, so the provider stops decoding) as soon as
+    on_partial() returns a verdict other than PARTIAL_CONTINUE.
+
+    Returns (resp, (text, usage)); the second item is None when the body was not an
+    event stream (error status / server ignored stream) -- it has been read, so the
+    caller handles resp like a normal response.
+    """
+    async with client.stream("POST", url, headers=headers, json=payload, timeout=timeout) as resp:
+        if resp.status_code >= 400 or "text/event-stream" not in resp.headers.get("content-type", ""):
+            await resp.aread()
+            return resp, None
+
+        text = ""
+        usage: Dict[str, Any] = {}
+        unchecked = 0
+        async for line in resp.aiter_lines():
+            if not line.startswith("data:"):
+                continue  # blank separators / ": keep-alive" comments
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                chunk = _json_loads(data)
+            except ValueError:
+                continue
+            if not isinstance(chunk, dict):
+                continue  # valid JSON but not a completion chunk
+
+            if chunk.get("usage"):
+                usage = chunk["usage"]
+            try:
+                delta = chunk["choices"][0]["delta"].get("content")
+            except (KeyError, IndexError, TypeError, AttributeError):
+                delta = None
+            if not delta:
+                continue
+
+            text += delta
+            unchecked += 1
+            if unchecked < STREAM_CHECK_EVERY:
+                continue
+            unchecked = 0
+            if on_partial(text) != PARTIAL_CONTINUE:
+                break  # early exit: leaving the block closes the response
+
+        return resp, (text, usage)
+
+
+async def call_llm(
+    model: str,
+    prompt: str,
+    max_tokens: int = 400,
+    on_partial: Optional[Callable[[str], str]] = None,
+    system: Optional[str] = None,
+    stop: Optional[List[str]] = None,
+) -> Tuple[str, Dict[str, Any]]:
     """
     Robust Unbound call with:
-    - HTTP/1.1 only
-    - retries with backoff (handles ReadError / timeouts / transient 5xx/429)
+    - shared keep-alive client (HTTP/1.1 unless UNBOUND_HTTP2=1)
+    - retries with jittered, capped backoff (handles ReadError / timeouts / transient 5xx/429,
+      honors Retry-After); other HTTP errors fail immediately
     - per-model timeout
+    - global concurrency cap (LLM_CONCURRENCY)
     - max_tokens to prevent huge outputs
+    - optional streaming: pass on_partial to stop generation early once the
+      output is known to pass ("valid") or fail ("invalid")
+    - optional system message (kept identical across calls so providers can cache it)
+    - optional stop sequences (provider stops decoding there; the sequence itself is not returned)
     """
 
     if not settings.unbound_chat_url:
@@ -41,18 +201,23 @@ async def call_llm(model: str, prompt: str, max_tokens: int = 400) -> Tuple[str,
     headers = {
         "Authorization": f"Bearer {settings.unbound_api_key}",
         "Content-Type": "application/json",
-        "Accept": "application/json",
+        "Accept": "text/event-stream" if on_partial else "application/json",
         "User-Agent": "agentic-workflow-builder/1.0",
-        "Connection": "close",  # helps with flaky keep-alive/proxies
     }
 
+    messages = [{"role": "user", "content": prompt}]
+    if system:
+        messages.insert(0, {"role": "system", "content": system})
+
     payload = {
         "model": model,
-        "messages": [{"role": "user", "content": prompt}],
+        "messages": messages,
         "temperature": 0.2,
         "max_tokens": max_tokens,
-        "stream": False,
+        "stream": on_partial is not None,
     }
+    if stop:
+        payload["stop"] = stop
 
     # Pick best timeout:
     # - env default used as baseline
@@ -62,54 +227,66 @@ async def call_llm(model: str, prompt: str, max_tokens: int = 400) -> Tuple[str,
     total_timeout = max(base_total, model_total)
 
     timeout = httpx.Timeout(total_timeout, connect=20.0, read=total_timeout)
-    limits = httpx.Limits(max_keepalive_connections=0, max_connections=10)
+
+    # Falls back to lazy init when used outside the app (e.g. runner demo)
+    client = _client or await open_client()
 
     last_err: Exception | None = None
+    sleep = BACKOFF_BASE_SECONDS
 
-    # 3 attempts
-    for attempt in range(1, 4):
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        retry_after = 0.0
         try:
-            async with httpx.AsyncClient(
-                timeout=timeout,
-                limits=limits,
-                http2=False,            # force HTTP/1.1
-                follow_redirects=True,
-            ) as client:
-                resp = await client.post(url, headers=headers, json=payload)
+            # hold a slot only for the request itself, not during backoff sleeps
+            async with LLM_CONCURRENCY:
+                if on_partial is None:
+                    resp = await client.post(url, headers=headers, json=payload, timeout=timeout)
+                    streamed = None
+                else:
+                    resp, streamed = await _post_streaming(client, url, headers, payload, timeout, on_partial)
 
-                # Retry on transient server/rate-limit errors
-                if resp.status_code in RETRYABLE_STATUS_CODES:
-                    last_err = UnboundError(f"Unbound transient {resp.status_code}: {resp.text[:300]}")
-                    raise last_err
+        except (httpx.ReadError, httpx.RemoteProtocolError, httpx.ReadTimeout, httpx.ConnectTimeout) as e:
+            last_err = e
 
-                if resp.status_code >= 400:
-                    raise UnboundError(f"Unbound error {resp.status_code}: {resp.text}")
+        except httpx.RequestError as e:
+            # other network errors (DNS, etc.)
+            raise UnboundError(f"Network error calling Unbound ({type(e).__name__}): {repr(e)}") from e
 
-                data = resp.json()
+        else:
+            # Retry on transient server/rate-limit errors (honor Retry-After on 429/503)
+            if resp.status_code in RETRYABLE_STATUS_CODES:
+                last_err = UnboundError(f"Unbound transient {resp.status_code}: {resp.text[:300]}")
+                retry_after = _retry_after_seconds(resp)
 
-            usage: Dict[str, Any] = data.get("usage", {}) if isinstance(data, dict) else {}
+            # Other 4xx/5xx (bad key, bad payload, ...) won't fix themselves -> fail fast
+            elif resp.status_code >= 400:
+                raise UnboundError(f"Unbound error {resp.status_code}: {resp.text}")
 
-            try:
-                text = data["choices"][0]["message"]["content"]
-            except Exception:
-                text = data.get("output") or data.get("text") or data.get("response")
+            elif streamed is not None:
+                text, usage = streamed
+                if text:
+                    return text, usage
 
-            if not text:
-                raise UnboundError(f"Could not parse response. Raw: {data}")
+                last_err = UnboundError("Empty streamed response")
 
-            return text, usage
+            else:
+                try:
+                    data = _json_loads(resp.content)
+                except ValueError:
+                    # e.g. an HTML error page from a proxy with status 200 -> retry like an unparseable body
+                    last_err = UnboundError(f"Unbound returned a non-JSON body: {resp.text[:300]}")
+                else:
+                    text, usage = _parse_response(data)
+                    if text:
+                        return text, usage
 
-        except (httpx.ReadError, httpx.RemoteProtocolError, httpx.ReadTimeout, httpx.ConnectTimeout, UnboundError) as e:
-            last_err = e
+                    last_err = UnboundError(f"Could not parse response. Raw: {data}")
 
-            # exponential-ish backoff + jitter: ~0.6s, 1.2s, 2.0s
-            base_sleep = 0.6 * attempt
-            jitter = random.uniform(0.0, 0.25)
-            await asyncio.sleep(base_sleep + jitter)
-            continue
+        if attempt == MAX_ATTEMPTS:
+            break
 
-        except httpx.RequestError as e:
-            # other network errors (DNS, etc.)
-            raise UnboundError(f"Network error calling Unbound ({type(e).__name__}): {repr(e)}") from e
+        # decorrelated jitter (spreads out concurrent runs retrying together), capped
+        sleep = min(BACKOFF_CAP_SECONDS, random.uniform(BACKOFF_BASE_SECONDS, sleep * 3))
+        await asyncio.sleep(max(sleep, retry_after))
 
-    raise UnboundError(f"Network ReadError after retries: {repr(last_err)}")
\ No newline at end of file
+    raise UnboundError(f"Unbound request failed after {MAX_ATTEMPTS} attempts: {repr(last_err)}")
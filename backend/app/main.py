@@ -2,25 +2,29 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from contextlib import asynccontextmanager
+import asyncio
 
-from app.llm_unbound import call_llm, UnboundError
+from app.llm_unbound import call_llm, close_client, open_client, UnboundError
 from app.routers import workflows, runs
-from app.db import Base, engine
-
-# ------------------------
-# Allowed models (hackathon)
-# ------------------------
-ALLOWED_MODELS = {
-    "kimi-k2p5",
-    "kimi-k2-instruct-0905",
-}
+from app.config import settings
+from app.constants import ALLOWED_MODELS, ModelName
+from app.db import init_db
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # ✅ Create DB tables on startup
-    Base.metadata.create_all(bind=engine)
+    # ✅ Create DB tables on startup (AUTO_MIGRATE=0 for multi-worker deploys)
+    if settings.auto_migrate:
+        init_db()
+    # ✅ One pooled HTTP client for all Unbound calls
+    await open_client()
+    # ✅ Background workflow runs (see routers/runs.py)
+    app.state.run_tasks = set()
     yield
+    for task in app.state.run_tasks:
+        task.cancel()
+    await asyncio.gather(*app.state.run_tasks, return_exceptions=True)
+    await close_client()
 
 
 app = FastAPI(title="Agentic Workflow Builder", lifespan=lifespan)
@@ -40,7 +44,7 @@ app.include_router(runs.router)
 
 
 class DebugLLMRequest(BaseModel):
-    model: str = Field(..., examples=["kimi-k2p5"])
+    model: str = Field(..., examples=[ModelName.K2P5])
     prompt: str = Field(..., examples=["Say hello in one sentence."])
 
 
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from datetime import datetime
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Text
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, String, Text
 from sqlalchemy.orm import relationship
 
 from app.db import Base
@@ -24,6 +24,10 @@ class Workflow(Base):
 
 class Step(Base):
     __tablename__ = "steps"
+    __table_args__ = (
+        # runner loads a workflow's steps ordered by step_order
+        Index("ix_steps_workflow_order", "workflow_id", "step_order"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
 
@@ -37,7 +41,7 @@ class Step(Base):
     criteria_value = Column(Text, nullable=True)        # keyword/pattern or empty for json_valid
 
     max_retries = Column(Integer, default=2, nullable=False)
-    context_mode = Column(String(20), default="full", nullable=False)  # "full" or "code_only"
+    context_mode = Column(String(20), default="full", nullable=False)  # "full", "code_only" or "none"
 
     workflow = relationship("Workflow", back_populates="steps")
 class Run(Base):
@@ -61,6 +65,10 @@ class Run(Base):
 
 class RunStep(Base):
     __tablename__ = "run_steps"
+    __table_args__ = (
+        # polled GET /runs/{id}: filter by run_id, order by (step_order, attempt_no)
+        Index("ix_run_steps_run_order_attempt", "run_id", "step_order", "attempt_no"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
 
@@ -3,63 +3,197 @@ from __future__ import annotations
 from datetime import datetime
 from typing import Any, Dict, List, Optional
 
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session, joinedload
 
 from app.db import get_db, SessionLocal
 from app import models, schemas
-from app.criteria import evaluate
+from app.config import settings
+from app.criteria import STEP_REGEX_FLAGS, make_partial_validator, make_validator
 from app.llm_unbound import call_llm, UnboundError
 import asyncio
+# Default response class on purpose: with a response_model FastAPI serializes straight
+# to JSON bytes in pydantic-core; ORJSONResponse is deprecated and disables that path
 router = APIRouter(prefix="/runs", tags=["runs"])
 
 
 def _build_criteria(step: models.Step) -> Dict[str, Any]:
     """
-    Convert DB fields (criteria_type/value) into criteria dict used by criteria.evaluate()
+    Convert DB fields (criteria_type/value) into criteria dict used by criteria.make_validator()
     """
     if not step.criteria_type:
-        return {"type": None}  # means "no criteria"
+        return {}  # means "no criteria" (always passes)
     if step.criteria_type == "contains":
         return {"type": "contains", "keyword": step.criteria_value or ""}
     if step.criteria_type == "regex":
-        return {"type": "regex", "pattern": step.criteria_value or "", "flags": "s"}
+        return {"type": "regex", "pattern": step.criteria_value or "", "flags": STEP_REGEX_FLAGS}
     if step.criteria_type == "json_valid":
         return {"type": "json_valid"}
     return {"type": step.criteria_type}  # unknown -> will fail in evaluate()
 
 
+_CONTEXT_HEADER = "### CONTEXT (output from previous step)\n"
+_TASK_HEADER = "\n\n### CURRENT TASK\n"
+
+
 def _inject_context(prompt: str, context: str) -> str:
-    if not context.strip():
+    if not context or context.isspace():
         return prompt.strip()
-    return (
-        "### CONTEXT (output from previous step)\n"
-        f"{context.strip()}\n\n"
-        "### CURRENT TASK\n"
-        f"{prompt.strip()}"
-    )
+    ctx = context.strip()
+    # single join into the final buffer (context can be a multi-KB LLM output)
+    return "".join((_CONTEXT_HEADER, ctx, _TASK_HEADER, prompt.strip()))
 
 
 def _context_from_output(output_text: str, context_mode: str) -> str:
+    # "none": step's output is not passed forward (next step starts fresh)
+    if context_mode == "none":
+        return ""
     # keep it simple: pass full output forward
     # (you can later re-enable code_only extraction if you want)
     return output_text
 
 
+def _independent_chains(steps: List[models.Step]) -> List[List[models.Step]]:
+    """
+    Split ordered steps into chains that don't depend on each other.
+    A step only consumes the previous step's output, so a step with
+    context_mode "none" ends its chain and the next step starts a new one.
+    """
+    chains: List[List[models.Step]] = [[]]
+    for step in steps:
+        chains[-1].append(step)
+        if step.context_mode == "none":
+            chains.append([])
+    return [c for c in chains if c]
+
+
+async def _run_step(db: Session, run_id: int, step: models.Step, context: str) -> Optional[str]:
+    """
+    Execute one step with criteria+retries, writing a RunStep row per attempt.
+    Returns the passing output, or None if the step failed permanently.
+    """
+    final_prompt = _inject_context(step.prompt, context)
+    # resolve criteria once per step, not per attempt
+    criteria = _build_criteria(step)
+    validator = make_validator(criteria)
+    # UNBOUND_STREAM=1: stream + stop generating once the criteria is decided
+    on_partial = make_partial_validator(criteria) if settings.unbound_stream else None
+
+    # ----------------------------
+    # Retries strategy
+    # - User-configured retries (step.max_retries)
+    # - plus extra retry "buffer" for flaky network, especially on slower model
+    # ----------------------------
+    base_retries = int(step.max_retries or 0)
+
+    # The instruct model is often slower / flakier → give it 2 extra attempts
+    extra_network_buffer = 2 if step.model == "kimi-k2-instruct-0905" else 1
+
+    total_attempts = (base_retries + extra_network_buffer) + 1  # +1 = first try
+
+    for attempt_no in range(1, total_attempts + 1):
+        try:
+            # ----------------------------
+            # Token cap (major ReadError reducer)
+            # ----------------------------
+            max_tokens = 300 if step.model == "kimi-k2p5" else 160
+
+            output_text, _usage = await call_llm(
+                model=step.model,
+                prompt=final_prompt,
+                max_tokens=max_tokens,
+                on_partial=on_partial,
+            )
+
+            # Evaluate criteria
+            crit_res = validator(output_text)
+
+            run_step = models.RunStep(
+                run_id=run_id,
+                step_id=step.id,
+                step_order=step.step_order,
+                status="PASSED" if crit_res.passed else "FAILED",
+                attempt_no=attempt_no,
+                prompt_used=final_prompt,
+                output=output_text,
+                criteria_result=crit_res.reason,
+                error=None,
+            )
+            db.add(run_step)
+            db.commit()
+
+            if crit_res.passed:
+                return output_text
+
+            # If criteria failed (not network), we can retry immediately (no sleep)
+
+        except UnboundError as e:
+            # Network / upstream error from Unbound wrapper
+            run_step = models.RunStep(
+                run_id=run_id,
+                step_id=step.id,
+                step_order=step.step_order,
+                status="ERROR",
+                attempt_no=attempt_no,
+                prompt_used=final_prompt,
+                output=None,
+                criteria_result=None,
+                error=str(e),
+            )
+            db.add(run_step)
+            db.commit()
+
+            # Backoff before retry to reduce flakiness / rate-limit issues
+            # 0.8s, 1.6s, 2.4s, ...
+            await asyncio.sleep(0.8 * attempt_no)
+            continue
+
+    return None
+
+
+async def _run_chain(run_id: int, step_ids: List[int]) -> bool:
+    """
+    Run dependent steps sequentially, passing context forward; stops on the first failed step.
+
+    Chains run concurrently, so each gets its own Session (one Session must not be shared
+    between tasks: commits expire the other chains' objects, a failed flush poisons them).
+    """
+    db: Session = SessionLocal()
+    try:
+        chain: List[models.Step] = (
+            db.query(models.Step)
+            .filter(models.Step.id.in_(step_ids))
+            .order_by(models.Step.step_order.asc())
+            .all()
+        )
+        context = ""
+        for step in chain:
+            output = await _run_step(db, run_id, step, context)
+            if output is None:
+                return False
+
+            # Step passed → update context for next step
+            context = _context_from_output(output, step.context_mode)
+        return True
+    finally:
+        db.close()
+
+
 async def _execute_workflow_background(run_id: int, workflow_id: int) -> None:
     """
     Background execution:
     - loads workflow steps
-    - executes sequentially with criteria+retries
+    - executes dependent steps sequentially with criteria+retries;
+      independent chains (split at context_mode "none") run concurrently
     - writes RunStep logs after each attempt
     - updates Run status to COMPLETED/FAILED
     """
     db: Session = SessionLocal()
-    context = ""
 
     try:
         # Ensure run exists
-        run = db.query(models.Run).filter(models.Run.id == run_id).first()
+        run = db.get(models.Run, run_id)
         if not run:
             return
 
@@ -74,138 +208,71 @@ async def _execute_workflow_background(run_id: int, workflow_id: int) -> None:
         if not steps:
             run.status = "FAILED"
             run.ended_at = datetime.utcnow()
-            db.add(run)
             db.commit()
             return
 
-        for step in steps:
-            final_prompt = _inject_context(step.prompt, context)
-            criteria = _build_criteria(step)
-
-            # ----------------------------
-            # Retries strategy
-            # - User-configured retries (step.max_retries)
-            # - plus extra retry "buffer" for flaky network, especially on slower model
-            # ----------------------------
-            base_retries = int(step.max_retries or 0)
-
-            # The instruct model is often slower / flakier → give it 2 extra attempts
-            extra_network_buffer = 2 if step.model == "kimi-k2-instruct-0905" else 1
-
-            total_attempts = (base_retries + extra_network_buffer) + 1  # +1 = first try
-
-            step_passed = False
-            last_output: Optional[str] = None
-            last_reason: str = ""
-
-            for attempt_no in range(1, total_attempts + 1):
-                try:
-                    # ----------------------------
-                    # Token cap (major ReadError reducer)
-                    # ----------------------------
-                    max_tokens = 300 if step.model == "kimi-k2p5" else 160
-
-                    output_text, _usage = await call_llm(
-                        model=step.model,
-                        prompt=final_prompt,
-                        max_tokens=max_tokens,
-                    )
-                    last_output = output_text
-
-                    # Evaluate criteria
-                    if not step.criteria_type:
-                        crit_res = evaluate(output_text, {})  # no criteria => pass
-                    else:
-                        crit_res = evaluate(output_text, criteria)
-
-                    last_reason = crit_res.reason
-
-                    run_step = models.RunStep(
-                        run_id=run.id,
-                        step_id=step.id,
-                        step_order=step.step_order,
-                        status="PASSED" if crit_res.passed else "FAILED",
-                        attempt_no=attempt_no,
-                        prompt_used=final_prompt,
-                        output=output_text,
-                        criteria_result=crit_res.reason,
-                        error=None,
-                    )
-                    db.add(run_step)
-                    db.commit()
-
-                    if crit_res.passed:
-                        step_passed = True
-                        break
-
-                    # If criteria failed (not network), we can retry immediately (no sleep)
-
-                except UnboundError as e:
-                    # Network / upstream error from Unbound wrapper
-                    run_step = models.RunStep(
-                        run_id=run.id,
-                        step_id=step.id,
-                        step_order=step.step_order,
-                        status="ERROR",
-                        attempt_no=attempt_no,
-                        prompt_used=final_prompt,
-                        output=None,
-                        criteria_result=None,
-                        error=str(e),
-                    )
-                    db.add(run_step)
-                    db.commit()
-
-                    last_reason = f"UnboundError: {str(e)}"
-
-                    # Backoff before retry to reduce flakiness / rate-limit issues
-                    # 0.8s, 1.6s, 2.4s, ...
-                    await asyncio.sleep(0.8 * attempt_no)
-                    continue
-
-            if not step_passed:
-                run.status = "FAILED"
-                run.ended_at = datetime.utcnow()
-                db.add(run)
-                db.commit()
-                return
-
-            # Step passed → update context for next step
-            context = _context_from_output(last_output or "", step.context_mode)
-
-        run.status = "COMPLETED"
+        # Wall time = slowest chain instead of sum of all steps (LLM_CONCURRENCY still caps requests)
+        tasks = [
+            asyncio.create_task(_run_chain(run_id, [step.id for step in chain]))
+            for chain in _independent_chains(steps)
+        ]
+        succeeded = True
+        try:
+            pending = set(tasks)
+            # first permanently failed chain fails the run -> stop as soon as one returns False
+            while pending and succeeded:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = all(task.result() for task in done)
+        finally:
+            # no-op once finished; stops sibling chains after a failure, an error or our cancellation
+            for task in tasks:
+                task.cancel()
+            # let them unwind (and close their sessions) before the final status is written
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        run.status = "COMPLETED" if succeeded else "FAILED"
         run.ended_at = datetime.utcnow()
-        db.add(run)
         db.commit()
 
+    except asyncio.CancelledError:
+        # Server shutdown cancels in-flight runs; don't leave them stuck in RUNNING
+        _mark_run_failed(db, run_id, "Run cancelled (server shutdown)")
+        raise
     except Exception as e:
-        # Mark run failed + store error as a run_step entry (optional but helpful)
-        try:
-            run = db.query(models.Run).filter(models.Run.id == run_id).first()
-            if run:
-                run.status = "FAILED"
-                run.ended_at = datetime.utcnow()
-                db.add(run)
-
-                err_step = models.RunStep(
-                    run_id=run_id,
-                    step_id=None,
-                    step_order=999999,  # puts it at the end
-                    status="ERROR",
-                    attempt_no=1,
-                    prompt_used="(system)",
-                    output=None,
-                    criteria_result=None,
-                    error=str(e),
-                )
-                db.add(err_step)
-
-                db.commit()
-        except Exception:
-            pass
+        _mark_run_failed(db, run_id, str(e))
     finally:
         db.close()
 
+
+def _mark_run_failed(db: Session, run_id: int, error: str) -> None:
+    """
+    Mark run failed + store error as a run_step entry (optional but helpful)
+    """
+    try:
+        db.rollback()
+        run = db.get(models.Run, run_id)
+        if run:
+            run.status = "FAILED"
+            run.ended_at = datetime.utcnow()
+
+            err_step = models.RunStep(
+                run_id=run_id,
+                step_id=None,
+                step_order=999999,  # puts it at the end
+                status="ERROR",
+                attempt_no=1,
+                prompt_used="(system)",
+                output=None,
+                criteria_result=None,
+                error=error,
+            )
+            db.add(err_step)
+
+            db.commit()
+    except Exception:
+        pass
+
+
 @router.get("/")
 def health():
     return {"message": "Runs router is wired up."}
@@ -216,14 +283,15 @@ def health():
     response_model=schemas.RunCreateResponse,
     status_code=status.HTTP_201_CREATED,
 )
-async def run_workflow(workflow_id: int, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+async def run_workflow(workflow_id: int, request: Request, db: Session = Depends(get_db)):
     """
     Milestone 6 change:
     - Create run row
     - Return run_id immediately
     - Execute workflow in background while UI polls GET /runs/{run_id}
+      (own asyncio task, decoupled from the request lifecycle)
     """
-    wf = db.query(models.Workflow).filter(models.Workflow.id == workflow_id).first()
+    wf = db.get(models.Workflow, workflow_id)
     if not wf:
         raise HTTPException(status_code=404, detail="Workflow not found")
 
@@ -240,38 +308,59 @@ async def run_workflow(workflow_id: int, background_tasks: BackgroundTasks, db:
     db.commit()
     db.refresh(run)
 
-    # Fire-and-forget
-    background_tasks.add_task(_execute_workflow_background, run.id, workflow_id)
+    # Fire-and-forget; keep a strong ref so the task isn't GC'd mid-run (cancelled on shutdown)
+    run_tasks = request.app.state.run_tasks
+    task = asyncio.create_task(_execute_workflow_background(run.id, workflow_id))
+    run_tasks.add(task)
+    task.add_done_callback(run_tasks.discard)
 
     return schemas.RunCreateResponse(run_id=run.id)
 
 
+def _run_etag(run: models.Run, step_count: int) -> str:
+    # RunStep rows are append-only, so (status, ended_at, row count) changes whenever the payload does
+    return f'W/"{run.id}-{run.status}-{run.ended_at.isoformat() if run.ended_at else ""}-{step_count}"'
+
+
 @router.get("/{run_id}", response_model=schemas.RunRead)
-def get_run(run_id: int, db: Session = Depends(get_db)):
-    run = db.query(models.Run).filter(models.Run.id == run_id).first()
-    if not run:
+def get_run(run_id: int, request: Request, response: Response, db: Session = Depends(get_db)):
+    # Polling UI: nothing changed since last poll -> 304 from one statement (run row +
+    # COUNT of its steps), without loading any (multi-KB) step rows
+    step_count_q = (
+        select(func.count(models.RunStep.id)).where(models.RunStep.run_id == models.Run.id).scalar_subquery()
+    )
+    row = db.query(models.Run, step_count_q).filter(models.Run.id == run_id).first()
+    if not row:
         raise HTTPException(status_code=404, detail="Run not found")
+    run, step_count = row
 
-    run_steps = (
-        db.query(models.RunStep)
-        .filter(models.RunStep.run_id == run_id)
-        .order_by(models.RunStep.step_order.asc(), models.RunStep.attempt_no.asc())
-        .all()
-    )
+    etag = _run_etag(run, step_count)
+    if request.headers.get("if-none-match") == etag:
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag, "Cache-Control": "no-cache"}
+        )
 
-    return schemas.RunRead(
-        id=run.id,
-        workflow_id=run.workflow_id,
-        status=run.status,
-        started_at=run.started_at,
-        ended_at=run.ended_at,
-        steps=run_steps,
+    # Changed: one query for run + its steps (ordered by the relationship's order_by);
+    # populate_existing refreshes the run loaded above in case it moved on meanwhile
+    run = (
+        db.query(models.Run)
+        .options(joinedload(models.Run.run_steps))
+        .filter(models.Run.id == run_id)
+        .populate_existing()
+        .one_or_none()
     )
+    if not run:
+        raise HTTPException(status_code=404, detail="Run not found")
+    # ETag of exactly what is returned
+    response.headers.update({"ETag": _run_etag(run, len(run.run_steps)), "Cache-Control": "no-cache"})
+
+    # validated once, from attributes, by the response_model adapter
+    return run
 
 
 @router.get("/workflows/{workflow_id}/runs", response_model=List[schemas.RunListItem])
 def list_workflow_runs(workflow_id: int, db: Session = Depends(get_db)):
-    wf = db.query(models.Workflow).filter(models.Workflow.id == workflow_id).first()
+    wf = db.get(models.Workflow, workflow_id)
     if not wf:
         raise HTTPException(status_code=404, detail="Workflow not found")
 
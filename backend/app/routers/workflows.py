@@ -1,13 +1,15 @@
 from __future__ import annotations
 
+import re
 from typing import List
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, insert
 
 from app.db import get_db
 from app import models, schemas
+from app.criteria import STEP_REGEX_FLAGS, compile_regex
 
 router = APIRouter(prefix="/workflows", tags=["workflows"])
 
@@ -21,26 +23,58 @@ def _ensure_unique_step_orders(steps: List[schemas.StepCreate]) -> None:
         )
 
 
+def _ensure_valid_regexes(steps: List[schemas.StepCreate]) -> None:
+    # Fail the save instead of the run; also warms the compiled-pattern cache for the first run
+    for s in steps:
+        if s.criteria_type != "regex":
+            continue
+        # an empty pattern compiles, but every run attempt would fail with "regex: missing pattern"
+        if not s.criteria_value:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid regex in step {s.step_order}: missing pattern",
+            )
+        try:
+            compile_regex(s.criteria_value, STEP_REGEX_FLAGS)
+        except re.error as e:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid regex in step {s.step_order}: {e}",
+            )
+
+
+def _insert_steps(db: Session, workflow_id: int, steps: List[schemas.StepCreate]) -> None:
+    # One executemany INSERT instead of N ORM-tracked objects
+    if not steps:
+        return
+    db.execute(
+        insert(models.Step),
+        [
+            {
+                "workflow_id": workflow_id,
+                "step_order": s.step_order,
+                "model": s.model,
+                "prompt": s.prompt,
+                "criteria_type": s.criteria_type,
+                "criteria_value": s.criteria_value,
+                "max_retries": s.max_retries,
+                "context_mode": s.context_mode,
+            }
+            for s in steps
+        ],
+    )
+
+
 @router.post("", response_model=schemas.WorkflowRead, status_code=status.HTTP_201_CREATED)
 def create_workflow(payload: schemas.WorkflowCreate, db: Session = Depends(get_db)):
     _ensure_unique_step_orders(payload.steps)
+    _ensure_valid_regexes(payload.steps)
 
     wf = models.Workflow(name=payload.name)
     db.add(wf)
     db.flush()  # get wf.id before inserting steps
 
-    for s in payload.steps:
-        step = models.Step(
-            workflow_id=wf.id,
-            step_order=s.step_order,
-            model=s.model,
-            prompt=s.prompt,
-            criteria_type=s.criteria_type,
-            criteria_value=s.criteria_value,
-            max_retries=s.max_retries,
-            context_mode=s.context_mode,
-        )
-        db.add(step)
+    _insert_steps(db, wf.id, payload.steps)
 
     db.commit()
     db.refresh(wf)
@@ -63,17 +97,14 @@ def list_workflows(db: Session = Depends(get_db)):
         .all()
     )
 
-    return [
-        schemas.WorkflowListItem(
-            id=r.id, name=r.name, created_at=r.created_at, step_count=r.step_count
-        )
-        for r in rows
-    ]
+    # rows carry exactly the WorkflowListItem fields; the response_model adapter
+    # validates the whole list in one pass
+    return rows
 
 
 @router.get("/{workflow_id}", response_model=schemas.WorkflowRead)
 def get_workflow(workflow_id: int, db: Session = Depends(get_db)):
-    wf = db.query(models.Workflow).filter(models.Workflow.id == workflow_id).first()
+    wf = db.get(models.Workflow, workflow_id)
     if not wf:
         raise HTTPException(status_code=404, detail="Workflow not found")
     return wf
@@ -82,8 +113,9 @@ def get_workflow(workflow_id: int, db: Session = Depends(get_db)):
 @router.put("/{workflow_id}", response_model=schemas.WorkflowRead)
 def update_workflow(workflow_id: int, payload: schemas.WorkflowUpdate, db: Session = Depends(get_db)):
     _ensure_unique_step_orders(payload.steps)
+    _ensure_valid_regexes(payload.steps)
 
-    wf = db.query(models.Workflow).filter(models.Workflow.id == workflow_id).first()
+    wf = db.get(models.Workflow, workflow_id)
     if not wf:
         raise HTTPException(status_code=404, detail="Workflow not found")
 
@@ -92,18 +124,7 @@ def update_workflow(workflow_id: int, payload: schemas.WorkflowUpdate, db: Sessi
     # Replace all steps (simple + reliable for hackathons)
     db.query(models.Step).filter(models.Step.workflow_id == workflow_id).delete()
 
-    for s in payload.steps:
-        step = models.Step(
-            workflow_id=workflow_id,
-            step_order=s.step_order,
-            model=s.model,
-            prompt=s.prompt,
-            criteria_type=s.criteria_type,
-            criteria_value=s.criteria_value,
-            max_retries=s.max_retries,
-            context_mode=s.context_mode,
-        )
-        db.add(step)
+    _insert_steps(db, workflow_id, payload.steps)
 
     db.commit()
     db.refresh(wf)
@@ -112,7 +133,7 @@ def update_workflow(workflow_id: int, payload: schemas.WorkflowUpdate, db: Sessi
 
 @router.delete("/{workflow_id}", status_code=status.HTTP_204_NO_CONTENT)
 def delete_workflow(workflow_id: int, db: Session = Depends(get_db)):
-    wf = db.query(models.Workflow).filter(models.Workflow.id == workflow_id).first()
+    wf = db.get(models.Workflow, workflow_id)
     if not wf:
         raise HTTPException(status_code=404, detail="Workflow not found")
 
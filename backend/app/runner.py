@@ -1,213 +1,463 @@
 from __future__ import annotations
 
-import re
-from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
+import asyncio
+import hashlib
+from collections import OrderedDict
+from types import MappingProxyType
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Mapping, NamedTuple, Optional, Sequence, Tuple
 
-from app.llm_unbound import call_llm
-from app.criteria import evaluate
+from app.config import settings
+from app.constants import ContextMode, ModelName
+from app.llm_unbound import UnboundError, call_llm
+from app.criteria import CriteriaResult, make_partial_validator, make_validator
 
 
-ALLOWED_MODELS = {"kimi-k2p5", "kimi-k2-instruct-0905"}
-
-
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Step:
     step_id: int
     name: str
     model: str
     prompt: str
-    criteria: Dict[str, Any]
+    criteria: Mapping[str, Any] = field(hash=False)  # read-only view after __post_init__
     max_retries: int = 2         # total attempts = max_retries + 1
     context_mode: str = "full"   # "full" or "code_only"
     max_tokens: int = 700
+    depends_on: Tuple[int, ...] = ()  # step_ids whose output is this step's context
+    speculative: int = 1         # attempts fired concurrently per round (>1 trades tokens for latency)
+    # provider stop sequences; they are cut from the output, so don't stop on text the criteria needs
+    stop: Optional[Tuple[str, ...]] = None
+    total_attempts: int = field(init=False, repr=False, compare=False)  # max_retries + 1
+    # criteria resolved once at construction (type dispatch + compiled regex)
+    validator: Callable[[str], CriteriaResult] = field(init=False, repr=False, compare=False)
+    # streaming check that can stop generation early (None -> nothing to decide early)
+    partial_validator: Optional[Callable[[str], str]] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        # frozen: derived/normalized fields are set once here, bypassing the generated __setattr__.
+        # Steps are shared by every run, so containers are copied into immutable ones
+        object.__setattr__(self, "criteria", MappingProxyType(dict(self.criteria)))
+        object.__setattr__(self, "depends_on", tuple(self.depends_on))
+        if self.stop is not None:
+            object.__setattr__(self, "stop", tuple(self.stop))
+        object.__setattr__(self, "model", ModelName(self.model))  # unsupported model -> ValueError
+        object.__setattr__(self, "total_attempts", self.max_retries + 1)
+        object.__setattr__(self, "validator", make_validator(self.criteria))
+        object.__setattr__(self, "partial_validator", make_partial_validator(self.criteria))
+
+
+# Rules shared by every demo step; sent as the system message so it is a stable,
+# provider-cacheable prefix instead of being repeated inside each prompt
+_SYSTEM_PROMPT = (
+    "You are a code generation step in an automated workflow.\n"
+    "Rules:\n"
+    "1) Output ONLY what the task asks for.\n"
+    "2) Do NOT include explanations, analysis, or any other text.\n"
+)
+
+
+class Attempt(NamedTuple):
+    n: int
+    passed: bool
+    reason: str
+    output: str
+    usage: Dict[str, Any]
+    cached: bool = False
+
+
+@dataclass(slots=True)
+class AttemptCols:
+    """
+    One step's attempts as parallel columns; rows are read back as Attempt tuples and
+    per-attempt dicts are only built once, when the step log is returned (to_dicts).
+    """
+    attempt_no: List[int] = field(default_factory=list)
+    passed: List[bool] = field(default_factory=list)
+    reason: List[str] = field(default_factory=list)
+    output: List[str] = field(default_factory=list)
+    usage: List[Dict[str, Any]] = field(default_factory=list)
+    cached: List[bool] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.attempt_no)
+
+    def __getitem__(self, i: int) -> Attempt:
+        return Attempt(
+            self.attempt_no[i], self.passed[i], self.reason[i], self.output[i], self.usage[i], self.cached[i]
+        )
 
+    def rows(self) -> Iterator[Attempt]:
+        return map(
+            Attempt._make,
+            zip(self.attempt_no, self.passed, self.reason, self.output, self.usage, self.cached),
+        )
 
-def _inject_context(prompt: str, context: str) -> str:
-    if not context.strip():
-        return prompt.strip()
-    return (
-        "### CONTEXT (output from previous step)\n"
-        f"{context.strip()}\n\n"
-        "### CURRENT TASK\n"
-        f"{prompt.strip()}"
-    )
+    def append(
+        self, attempt_no: int, passed: bool, reason: str, output: str, usage: Dict[str, Any], cached: bool = False
+    ) -> None:
+        self.attempt_no.append(attempt_no)
+        self.passed.append(passed)
+        self.reason.append(reason)
+        self.output.append(output)
+        self.usage.append(usage)
+        self.cached.append(cached)
+
+    def to_dicts(self) -> List[Dict[str, Any]]:
+        # only the last attempt (the passing one, or the final failure) keeps its full
+        # text; earlier ones are summarized so failing steps don't carry every output
+        last = len(self) - 1
+        rows: List[Dict[str, Any]] = []
+        for i, a in enumerate(self.rows()):
+            row: Dict[str, Any] = {"attempt": a.n, "passed": a.passed, "reason": a.reason}
+            if i == last:
+                row.update(output=a.output, usage=a.usage)
+            else:
+                digest = hashlib.blake2b(a.output.encode(), digest_size=8).hexdigest()
+                row.update(usage=a.usage, output_len=len(a.output), output_hash=digest)
+            if a.cached:
+                row["cached"] = True
+            rows.append(row)
+        return rows
+
+
+_CONTEXT_HEADER = "\n\n### CONTEXT (output from previous step)\n"
 
 
-_CODE_BLOCK_RE = re.compile(r"```(?:\w+)?\s*([\s\S]*?)```", re.MULTILINE)
+def _inject_context(prompt: str, context: str) -> str:
+    # static task text first, variable context last -> longest stable prompt prefix
+    if not context or context.isspace():
+        return prompt.strip()
+    # strip each part once, then a single join (context can be a multi-KB LLM output)
+    return "".join((prompt.strip(), _CONTEXT_HEADER, context.strip()))
 
 
 def _extract_first_code_block(text: str) -> Optional[str]:
     if not text:
         return None
-    m = _CODE_BLOCK_RE.search(text)
-    if m:
-        return m.group(1).strip()
-
-    # unclosed fence fallback
     start = text.find("```")
-    if start != -1:
-        after = text[start + 3 :]
-        after = re.sub(r"^\w+\s*\n", "", after)
-        return after.strip()
+    if start == -1:
+        return None
+
+    # skip an optional language tag right after the opening fence
+    body = start + 3
+    lang_end = body
+    while lang_end < len(text) and (text[lang_end].isalnum() or text[lang_end] == "_"):
+        lang_end += 1
 
-    return None
+    end = text.find("```", lang_end)
+    if end != -1:
+        return text[lang_end:end].strip()
+
+    # unclosed fence fallback: drop the tag only if it sits on its own line
+    rest = text[lang_end:]
+    if lang_end > body and "\n" in rest[: len(rest) - len(rest.lstrip())]:
+        return rest.strip()
+    return text[body:].strip()
 
 
 def _context_from_output(output_text: str, mode: str) -> str:
-    if mode == "code_only":
+    if mode == ContextMode.CODE_ONLY:
         code = _extract_first_code_block(output_text)
         return f"```python\n{code}\n```" if code else output_text
     return output_text
 
 
-async def run_demo_workflow_v3() -> Dict[str, Any]:
+# LRU of passing outputs keyed by (model, max_tokens, normalized prompt): the demo
+# prompts are static, so repeated runs can skip the network entirely
+_RESPONSE_CACHE_MAX = 1024
+_response_cache: "OrderedDict[str, Tuple[str, Dict[str, Any]]]" = OrderedDict()
+
+
+def _normalize_prompt(prompt: str) -> str:
+    # Near-duplicate prompts (injected context differing only in trailing spaces, blank
+    # lines or CRLF) share a key; leading indentation is kept since it is meaningful in code
+    return "\n".join(line.rstrip() for line in prompt.strip().splitlines() if line.strip())
+
+
+def _cache_key(model: str, max_tokens: int, prompt: str) -> str:
+    normalized = _normalize_prompt(prompt)
+    return hashlib.blake2b(f"{model}|{max_tokens}|{normalized}".encode(), digest_size=16).hexdigest()
+
+
+def _cache_get(key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+    hit = _response_cache.get(key)
+    if hit is not None:
+        _response_cache.move_to_end(key)
+    return hit
+
+
+def _cache_put(key: str, output: str, usage: Dict[str, Any]) -> None:
+    _response_cache[key] = (output, usage)
+    _response_cache.move_to_end(key)
+    if len(_response_cache) > _RESPONSE_CACHE_MAX:
+        _response_cache.popitem(last=False)
+
+
+# Identical requests already in flight from concurrent demo runs share one provider
+# call. The attempt slot is part of the key so a step's own speculative attempts and
+# retries still get independent samples.
+@dataclass
+class _InFlight:
+    task: "asyncio.Task[Tuple[str, Dict[str, Any]]]"
+    waiters: int = 0
+
+
+_inflight: Dict[Tuple[Any, ...], _InFlight] = {}
+
+
+async def _call_llm_shared(key: Tuple[Any, ...], **kwargs: Any) -> Tuple[str, Dict[str, Any]]:
+    entry = _inflight.get(key)
+    if entry is None:
+        entry = _InFlight(asyncio.create_task(call_llm(**kwargs)))
+        _inflight[key] = entry
+        entry.task.add_done_callback(lambda _t, e=entry: _inflight.pop(key, None) if _inflight.get(key) is e else None)
+
+    entry.waiters += 1
+    try:
+        return await asyncio.shield(entry.task)
+    finally:
+        entry.waiters -= 1
+        # last interested caller gone (e.g. losing speculative attempt) -> stop the request
+        if entry.waiters == 0 and not entry.task.done():
+            entry.task.cancel()
+            if _inflight.get(key) is entry:
+                del _inflight[key]
+
+
+def _waves(steps: Sequence[Step]) -> List[List[Step]]:
     """
-    Milestone 3 demo runner:
-    - sequential execution
-    - context passing
-    - criteria evaluation + retries
-    - stops workflow on permanent fail
+    Group steps into waves (Kahn's algorithm): every step's dependencies are in
+    earlier waves, so steps within a wave can run concurrently.
     """
+    known = {s.step_id for s in steps}
+    pending = list(steps)
+    done: set[int] = set()
+    waves: List[List[Step]] = []
 
-    steps: List[Step] = [
-        Step(
-            step_id=1,
-            name="Write add() function",
-            model="kimi-k2p5",
-            context_mode="code_only",
-            max_tokens=250,
-            max_retries=1,
-            prompt=(
-                "Write Python code that defines a function add(a, b) which returns a + b.\n"
-                "Return ONLY a single Python code block. No explanations."
-            ),
-            criteria={
-                "type": "regex",
-                "pattern": r"```python[\s\S]*```",
-                "flags": "s",
-            },
-        ),
-        Step(
-            step_id=2,
-            name="Write pytest tests",
-            model="kimi-k2p5",
-            context_mode="code_only",
-            max_tokens=900,
-            max_retries=3,
-            prompt=(
-                "Using the CONTEXT code above, write EXACTLY 3 pytest test cases for add(a, b).\n"
-                "Rules:\n"
-                "1) Return ONLY a single Python code block.\n"
-                "2) Do NOT include explanations, analysis, or any text outside the code block.\n"
-                "3) Assume add() is already available. Do NOT write placeholder imports.\n"
-            ),
-            criteria={
-                "type": "regex",
-                # must contain a python code block
-                "pattern": r"```python[\s\S]*```",
-                "flags": "s",
-            },
-        ),
-        Step(
-            step_id=3,
-            name="Generate requirements.txt",
-            model="kimi-k2-instruct-0905",
-            context_mode="full",
-            max_tokens=80,
-            max_retries=2,
-            prompt=(
-                "From the CONTEXT above, output requirements.txt lines ONLY.\n"
-                "Rules:\n"
-                "1) Output ONLY package names (one per line).\n"
-                "2) Do NOT use code fences.\n"
-                "3) Do NOT add explanations.\n"
-                "If pytest tests exist, include pytest.\n"
-            ),
-            criteria={
-                "type": "contains",
-                "keyword": "pytest",
-            },
-        ),
-    ]
-
-    # validate models
     for s in steps:
-        if s.model not in ALLOWED_MODELS:
-            raise ValueError(f"Unsupported model '{s.model}'. Choose from: {', '.join(sorted(ALLOWED_MODELS))}")
+        missing = set(s.depends_on) - known
+        if missing:
+            raise ValueError(f"Step {s.step_id} depends on unknown step(s): {sorted(missing)}")
 
-    workflow_status = "COMPLETED"
-    context: str = ""
-    step_logs: List[Dict[str, Any]] = []
+    while pending:
+        ready = [s for s in pending if done.issuperset(s.depends_on)]
+        if not ready:
+            raise ValueError(f"Dependency cycle between steps: {[s.step_id for s in pending]}")
+        waves.append(ready)
+        done.update(s.step_id for s in ready)
+        pending = [s for s in pending if s.step_id not in done]
 
-    for step in steps:
-        final_prompt = _inject_context(step.prompt, context)
+    return waves
 
-        attempts: List[Dict[str, Any]] = []
-        passed = False
-        final_output = ""
-        final_usage: Dict[str, Any] = {}
 
-        total_attempts = step.max_retries + 1
+def _context_for(step: Step, contexts: Dict[int, str]) -> str:
+    return "\n\n".join(contexts[d] for d in step.depends_on if contexts.get(d))
 
-        for attempt_num in range(1, total_attempts + 1):
-            output_text, usage = await call_llm(
-                model=step.model,
-                prompt=final_prompt,
-                max_tokens=step.max_tokens,
-            )
 
-            crit = evaluate(output_text, step.criteria)
+async def _run_step(step: Step, context: str) -> Dict[str, Any]:
+    """
+    Criteria + retries for one step; returns its step log.
+    """
+    final_prompt = _inject_context(step.prompt, context)
+
+    attempts = AttemptCols()
+    passed = False
+    final_output = ""
+
+    total_attempts = step.total_attempts
+    attempt_num = 0
+    any_response = False
+    last_error: Optional[UnboundError] = None
+    # e.g. contains:"pytest" is settled as soon as the keyword streams in
+    on_partial = step.partial_validator if settings.unbound_stream else None
+    request_key = (
+        step.model,
+        step.max_tokens,
+        final_prompt,
+        on_partial is not None,
+        tuple(sorted(step.criteria.items())),
+        step.stop or (),
+    )
 
-            attempts.append(
-                {
-                    "attempt": attempt_num,
-                    "passed": crit.passed,
-                    "reason": crit.reason,
-                    "output": output_text,
-                    "usage": usage,
-                }
+    # Same (or whitespace-equivalent) prompt answered and passed before -> reuse it
+    # if it still meets this step's criteria
+    # key computed once per step: normalizing + hashing a multi-KB prompt isn't free
+    cache_key = _cache_key(step.model, step.max_tokens, final_prompt)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        output_text, usage = cached
+        crit = step.validator(output_text)
+        if crit.passed:
+            passed = True
+            final_output = output_text
+            attempts.append(1, True, crit.reason, output_text, usage, cached=True)
+
+    # Retries reuse the identical prompt, so a round can fire several attempts at once
+    # and keep the first that passes (speculative=1 -> plain sequential retries)
+    while attempt_num < total_attempts and not passed:
+        batch = min(max(step.speculative, 1), total_attempts - attempt_num)
+        tasks = [
+            asyncio.create_task(
+                _call_llm_shared(
+                    request_key + (slot,),
+                    model=step.model,
+                    prompt=final_prompt,
+                    max_tokens=step.max_tokens,
+                    on_partial=on_partial,
+                    system=_SYSTEM_PROMPT,
+                    stop=list(step.stop) if step.stop else None,
+                )
             )
+            for slot in range(attempt_num, attempt_num + batch)
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    output_text, usage = await next_done
+                except UnboundError as e:
+                    # one failed request must not cancel sibling attempts that may still pass
+                    attempt_num += 1
+                    last_error = e
+                    attempts.append(attempt_num, False, f"error: {e}", "", {})
+                    continue
+                attempt_num += 1
+                any_response = True
+
+                crit = step.validator(output_text)
+
+                attempts.append(attempt_num, crit.passed, crit.reason, output_text, usage)
+
+                if crit.passed:
+                    passed = True
+                    final_output = output_text
+                    _cache_put(cache_key, output_text, usage)
+                    break
+        finally:
+            # drop the slower speculative attempts (no-op for finished ones)
+            for task in tasks:
+                task.cancel()
+
+    # whole budget spent on request errors (no output to judge) -> surface the error
+    if not passed and not any_response and last_error is not None:
+        raise last_error
+
+    log: Dict[str, Any] = {
+        "step_id": step.step_id,
+        "name": step.name,
+        "model": step.model,
+        "criteria": dict(step.criteria),  # copy: the step's criteria are shared across runs
+        "passed": passed,
+        "attempts": attempts.to_dicts(),
+        "final_output": final_output if passed else (attempts[-1].output if attempts else ""),
+    }
+    # the prompt is step.prompt + the dependencies' context, so only its length is
+    # logged unless DEMO_LOG_PROMPTS=1
+    if settings.demo_log_prompts:
+        log["prompt_used"] = final_prompt
+    else:
+        log["prompt_used_len"] = len(final_prompt)
+    return log
+
+
+# Built once at import: criteria are resolved and models checked (Step.__post_init__)
+# here, not on every run
+_DEMO_STEPS: Tuple[Step, ...] = (
+    Step(
+        step_id=1,
+        name="Write add() function",
+        model="kimi-k2p5",
+        context_mode="code_only",
+        max_tokens=250,
+        max_retries=1,
+        prompt=(
+            "Write Python code that defines a function add(a, b) which returns a + b.\n"
+            "Return ONLY a single Python code block."
+        ),
+        criteria={
+            "type": "regex",
+            "pattern": r"```python[\s\S]*```",
+            "flags": "s",
+        },
+    ),
+    Step(
+        step_id=2,
+        name="Write pytest tests",
+        model="kimi-k2p5",
+        context_mode="code_only",
+        max_tokens=900,
+        max_retries=3,
+        depends_on=(1,),
+        prompt=(
+            "Using the CONTEXT code below, write EXACTLY 3 pytest test cases for add(a, b).\n"
+            "Return ONLY a single Python code block.\n"
+            "Assume add() is already available. Do NOT write placeholder imports.\n"
+        ),
+        criteria={
+            "type": "regex",
+            # must contain a python code block
+            "pattern": r"```python[\s\S]*```",
+            "flags": "s",
+        },
+    ),
+    Step(
+        step_id=3,
+        name="Generate requirements.txt",
+        model="kimi-k2-instruct-0905",
+        context_mode="full",
+        max_tokens=80,
+        max_retries=2,
+        depends_on=(2,),
+        prompt=(
+            "From the CONTEXT below, output requirements.txt lines ONLY.\n"
+            "Output package names (one per line) and do NOT use code fences.\n"
+            "If pytest tests exist, include pytest.\n"
+        ),
+        criteria={
+            "type": "contains",
+            "keyword": "pytest",
+        },
+    ),
+)
+
+_DEMO_WAVES = _waves(_DEMO_STEPS)  # dependency check also runs once
+
+
+async def run_demo_workflow_v3() -> Dict[str, Any]:
+    """
+    Milestone 3 demo runner:
+    - dependency-ordered execution (independent steps concurrently)
+    - context passing
+    - criteria evaluation + retries
+    - stops workflow on permanent fail
+    """
 
-            if crit.passed:
-                passed = True
-                final_output = output_text
-                final_usage = usage
-                break
+    workflow_status = "COMPLETED"
+    contexts: Dict[int, str] = {}  # step_id -> context it passes to dependents
+    step_logs: List[Dict[str, Any]] = []
 
-        if not passed:
+    # independent steps in a wave run concurrently (call_llm's LLM_CONCURRENCY caps requests)
+    for wave in _DEMO_WAVES:
+        tasks = [asyncio.create_task(_run_step(s, _context_for(s, contexts))) for s in wave]
+        try:
+            logs = await asyncio.gather(*tasks)
+        finally:
+            # no-op once finished; if a step raised (or we got cancelled) stop its siblings
+            # instead of leaving them calling the LLM with nobody awaiting them
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        for step, log in zip(wave, logs):
+            step_logs.append(log)
+            if log["passed"]:
+                # step passed -> its context is available to dependents
+                contexts[step.step_id] = _context_from_output(log["final_output"], step.context_mode)
+
+        if not all(log["passed"] for log in logs):
             workflow_status = "FAILED"
-            step_logs.append(
-                {
-                    "step_id": step.step_id,
-                    "name": step.name,
-                    "model": step.model,
-                    "prompt_used": final_prompt,
-                    "criteria": step.criteria,
-                    "passed": False,
-                    "attempts": attempts,
-                    "final_output": attempts[-1]["output"] if attempts else "",
-                }
-            )
-            # stop the workflow immediately
+            # stop the workflow after this wave
             break
 
-        # step passed -> update context for next step
-        context = _context_from_output(final_output, step.context_mode)
-
-        step_logs.append(
-            {
-                "step_id": step.step_id,
-                "name": step.name,
-                "model": step.model,
-                "prompt_used": final_prompt,
-                "criteria": step.criteria,
-                "passed": True,
-                "attempts": attempts,
-                "final_output": final_output,
-            }
-        )
-
     return {
         "workflow_name": "Demo Workflow (Milestone 3: Criteria + Retries)",
         "workflow_status": workflow_status,
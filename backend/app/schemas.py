@@ -1,26 +1,23 @@
 from __future__ import annotations
 
 from datetime import datetime
-from typing import List, Optional, Literal
+from typing import List, Optional
 
-from pydantic import BaseModel, Field
+from pydantic import AliasChoices, BaseModel, ConfigDict, Field
 
-
-AllowedModel = Literal["kimi-k2p5", "kimi-k2-instruct-0905"]
-ContextMode = Literal["full", "code_only"]
-CriteriaType = Literal["contains", "regex", "json_valid"]
+from app.constants import ContextMode, CriteriaType, ModelName
 
 
 class StepBase(BaseModel):
     step_order: int = Field(..., ge=1)
-    model: AllowedModel
+    model: ModelName
     prompt: str = Field(..., min_length=1)
 
     criteria_type: Optional[CriteriaType] = None
     criteria_value: Optional[str] = None
 
     max_retries: int = Field(default=2, ge=0, le=10)
-    context_mode: ContextMode = "full"
+    context_mode: ContextMode = ContextMode.FULL
 
 
 class StepCreate(StepBase):
@@ -31,8 +28,7 @@ class StepRead(StepBase):
     id: int
     workflow_id: int
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class WorkflowBase(BaseModel):
@@ -52,8 +48,7 @@ class WorkflowRead(WorkflowBase):
     created_at: datetime
     steps: List[StepRead] = Field(default_factory=list)
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class WorkflowListItem(BaseModel):
@@ -62,8 +57,7 @@ class WorkflowListItem(BaseModel):
     created_at: datetime
     step_count: int
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 class RunCreateResponse(BaseModel):
     run_id: int
 
@@ -82,8 +76,7 @@ class RunStepLog(BaseModel):
     criteria_result: Optional[str] = None
     error: Optional[str] = None
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class RunRead(BaseModel):
@@ -92,10 +85,10 @@ class RunRead(BaseModel):
     status: str
     started_at: datetime
     ended_at: Optional[datetime] = None
-    steps: List[RunStepLog] = []
+    # read straight from Run.run_steps when validating the ORM object
+    steps: List[RunStepLog] = Field(default_factory=list, validation_alias=AliasChoices("steps", "run_steps"))
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class RunListItem(BaseModel):
@@ -105,5 +98,4 @@ class RunListItem(BaseModel):
     started_at: datetime
     ended_at: Optional[datetime] = None
 
-    class Config:
-        from_attributes = True
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True)
\ No newline at end of file
@@ -6,7 +6,7 @@ const API_BASE = "http://127.0.0.1:8000";
 // Allowed hackathon models
 const MODELS = ["kimi-k2p5", "kimi-k2-instruct-0905"];
 const CRITERIA_TYPES = ["contains", "regex", "json_valid"];
-const CONTEXT_MODES = ["full", "code_only"];
+const CONTEXT_MODES = ["full", "code_only", "none"];
 
 // =========================
 // DOM